@@ -1,10 +1,40 @@
 # Standard imports
+from collections import namedtuple
+import logging
+import logging.handlers
 from pathlib import Path
+import sys
 
 # Third-party imports
+import h5py
 from netCDF4 import Dataset
 import numpy as np
 
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Metadata and variables of a prior in the priors file
+PriorMeta = namedtuple("PriorMeta", "key source prior run_type variables")
+
+# SoS group for each prior source; all other sources are USGS
+_SOURCE_GROUP = {
+    "wbm": "model",
+    "grades": "model",
+    "grdc": "model/grdc",
+    "gbreach": "gbpriors/reach",
+    "gbnode": "gbpriors/node"
+}
+
+# Source name displayed in status messages
+_PRINT_SOURCE = {
+    "wbm": "WBM",
+    "grades": "GRADES",
+    "grdc": "GRDC",
+    "usgs": "USGS",
+    "gbreach": "GBPRIORS",
+    "gbnode": "GBPRIORS"
+}
+
 class Overwrite:
     """Class that overwrites priors in the SOS that are retrieved from a 
     specifically structured NetCDF file.
@@ -15,19 +45,63 @@ class Overwrite:
         Path to NetCDF with priors data
     sos_file: Path
         Path to the SoS file that contains priors to be overwritten
+    _priors_ds: netCDF4.Dataset
+        Dataset with priors data kept open until close is called
+    _id_cache: dict
+        SoS identifier to index lookups keyed on (run_type, identifier path)
+    _t_cache: dict
+        SoS time value to index lookups or regular axis (start, step, size)
+        keyed on (run_type, group, prior)
+    CHUNK_CACHE_SIZE: int
+        Size in bytes of the chunk cache for SoS variables being overwritten
+    CHUNK_CACHE_NELEMS: int
+        Number of chunk slots in the chunk cache for SoS variables
+    CHUNK_CACHE_PREEMPTION: float
+        Preemption of fully read or written chunks from the chunk cache
+    DENSE_FRACTION: float
+        Fraction of a SoS variable above which it is overwritten whole
+    MIN_RUN_LENGTH: int
+        Average length of contiguous index runs above which runs are written
+        as individual slices
+    SAMPLE_SIZE: int
+        Number of values compared to detect SoS data that is already current
+    SEPARATOR: str
+        Separator between a prior's name and its variable names
 
     Methods
     -------
+    close()
+        Close the priors dataset
     determine_group(source)
         Determine the group the prior is generated for
-    locate_sos_file(priors_file)
-        Locate the SoS file with priors that will be overwritten
-    overwrite()
+    is_unchanged(sos_var, indexes, data, index_t=None)
+        Determine if SoS variable already holds prior data
+    locate_priors(priors_ds)
+        Locate the metadata and variables of each prior grouped by run type
+    lookup_indexes(lookup, values)
+        Map values to SoS indexes
+    overwrite(sos_dir, parallel=False)
         Overwrite priors in the SoS file
-    retrieve_ids(source, priors_ds, sos_ds)
+    read_ids(run_type, sos_file, metas)
+        Read SoS identifiers directly from the HDF5 file
+    retrieve_ids(source, run_type, prior_vars)
         Retrieve reach identifiers for priors and from SoS
+    retrieve_times(run_type, group, prior, sos_ds)
+        Retrieve time values from SoS
+    sos_id_path(source, prior_vars)
+        Determine the path of the SoS identifiers for a prior
+    write_prior(sos_var, prior_indexes, prior_data, index_t=None, dense=True)
+        Write prior data to SoS variable
     """
 
+    CHUNK_CACHE_SIZE = 64 * 1024 * 1024
+    CHUNK_CACHE_NELEMS = 4091
+    CHUNK_CACHE_PREEMPTION = 0.75
+    DENSE_FRACTION = 0.5
+    MIN_RUN_LENGTH = 64
+    SAMPLE_SIZE = 1024
+    SEPARATOR = "__"
+
     def __init__(self, priors_file):
         """
         Parameters
@@ -37,7 +111,24 @@ class Overwrite:
         """
 
         self.priors_file = priors_file
-        self.sos_file = self.locate_sos_file(priors_file)
+        self._priors_ds = Dataset(priors_file, 'r')
+        self._priors_ds.set_auto_mask(False)
+        self._priors_ds.set_auto_scale(False)
+        self._priors_ds.set_always_mask(False)
+        self.sos_file = self._priors_ds.sos_file
+        self._id_cache = {}
+        self._t_cache = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the priors dataset."""
+
+        if self._priors_ds.isopen(): self._priors_ds.close()
 
     def determine_group(self, source):
         """Determine the group the prior is generated for.
@@ -48,119 +139,369 @@ class Overwrite:
             Data source prior was generated from/for
         """
 
-        if source == "wbm" or source == "grades":
-            group = "model"
-        elif source == "grdc":
-            group = "model/grdc"
-        elif source == "gbreach":
-            group = "gbpriors/reach"
-        elif source == "gbnode":
-            group = "gbpriors/node"
+        return _SOURCE_GROUP.get(source, "model/usgs")
+
+    def is_unchanged(self, sos_var, indexes, data, index_t=None):
+        """Determine if SoS variable already holds prior data.
+
+        Parameters
+        ----------
+        sos_var: netCDF4.Variable
+            SoS variable to compare against
+        indexes: numpy.ndarray
+            Sorted SoS indexes of prior data
+        data: numpy.ndarray
+            Prior data values
+        index_t: numpy.ndarray
+            SoS time indexes of prior data (optional)
+        """
+
+        existing = sos_var[indexes] if index_t is None else sos_var[indexes, index_t]
+        return np.array_equal(existing, data)
+
+    def locate_priors(self, priors_ds):
+        """Locate the metadata and variables of each prior grouped by run type.
+
+        Priors are stored as variables named '<source>_<prior>__<name>' with
+        the run type as an attribute of the prior values. Priors files that
+        store each prior in its own group are also supported. Each run type
+        maps to a list of PriorMeta.
+
+        Parameters
+        ----------
+        priors_ds: netCDF4.Dataset
+            Dataset with prior values
+        """
+
+        if priors_ds.groups:
+            metas = [PriorMeta(key, *key.partition('_')[::2], g.run_type, g.variables)
+                for key, g in priors_ds.groups.items()]
         else:
-            group = "model/usgs"
-        
-        return group 
+            priors = {}
+            for name, var in priors_ds.variables.items():
+                key, _, var_name = name.rpartition(self.SEPARATOR)
+                priors.setdefault(key, {})[var_name] = var
+            metas = [PriorMeta(key, *key.partition('_')[::2], prior_vars["prior_values"].run_type, prior_vars)
+                for key, prior_vars in priors.items()]
+
+        by_runtype = {}
+        for meta in metas:
+            by_runtype.setdefault(meta.run_type, []).append(meta)
+        return by_runtype
+
+    def lookup_indexes(self, lookup, values):
+        """Map values to SoS indexes; values not present in the SoS map to -1.
 
-    def locate_sos_file(self, priors_file):
-        """Locate the SoS file with priors that will be overwritten.
-        
         Parameters
         ----------
-        priors_file: Path
-            Path to NetCDF with priors data
+        lookup: dict or tuple
+            Dictionary of SoS value to index or (start, step, size) of a
+            regular SoS axis
+        values: numpy.ndarray
+            Array of values to map
         """
 
-        ds = Dataset(priors_file, 'r')
-        sos_file = ds.sos_file
-        ds.close()
-        return sos_file
+        # Regular axis
+        if isinstance(lookup, tuple):
+            start, step, size = lookup
+            offsets = np.asarray(values, dtype=np.int64) - start
+            indexes = offsets // step
+            indexes[(offsets % step != 0) | (indexes < 0) | (indexes >= size)] = -1
+            return indexes
 
-    def overwrite(self, sos_dir):
+        return np.fromiter((lookup.get(value, -1) for value in values.tolist()),
+            dtype=np.int64, count=len(values))
+
+    def overwrite(self, sos_dir, parallel=False):
         """Overwrite priors in the SoS file.
+
+        In parallel mode priors are partitioned across MPI ranks and each rank
+        writes its priors independently to SoS files opened for parallel I/O.
         
         Parameters
         ----------
         sos_dir: Path
             Path to directory that contains the current SoS
+        parallel: bool
+            Indicates whether to overwrite priors in parallel with MPI
         """
 
-        priors_ds = Dataset(self.priors_file, 'r')
+        self._id_cache = {}
+        self._t_cache = {}
 
-        for key in priors_ds.groups.keys():
+        # Bucket priors by run type so each SoS file is opened once
+        by_runtype = self.locate_priors(self._priors_ds)
 
-            # Prior data
-            source = key.split('_')[0]
-            prior = '_'.join(key.split('_')[1:])
-            run_type = priors_ds[key].run_type
-            prior_indexes = priors_ds[key]["indexes"][:]
-            data = priors_ds[key]["prior_values"][:]
-            group = self.determine_group(source)
+        # Partition priors across MPI ranks
+        if parallel:
+            from mpi4py import MPI
+            comm = MPI.COMM_WORLD
+            rank_keys = None
+            if comm.rank == 0:
+                keys = [meta.key for metas in by_runtype.values() for meta in metas]
+                rank_keys = [keys[i::comm.size] for i in range(comm.size)]
+            rank_keys = set(comm.scatter(rank_keys, root=0))
+
+        for run_type, metas in by_runtype.items():
 
             # SoS data
             sos_file = sos_dir / run_type / self.sos_file
-            sos_ds = Dataset(sos_file, 'a')
-
-            # Test data
-            if "reach_id" in priors_ds[key].variables.keys():
-                prior_ids, sos_ids = self.retrieve_ids(source, priors_ds[key], sos_ds)
-            else:
-                prior_ids = priors_ds[key]["node_id"][:]
-                sos_ids = sos_ds["nodes"]["node_id"][:]
-            sorter = np.argsort(sos_ids)
-            test_indexes = sorter[np.searchsorted(sos_ids, prior_ids, sorter=sorter)]
-
-            # Overwrite
-            if "value_t" in priors_ds[key].variables.keys():
-                prior_t = priors_ds[key]["value_t"][:].astype(int)[0]
-                sos_t = sos_ds[group][f"{prior}t"][:].astype(int)[0]
-                sorter = np.argsort(sos_t)
-                index_t = sorter[np.searchsorted(sos_t, prior_t, sorter=sorter)]
-                sos_ds[group][prior][prior_indexes,index_t] = data[0]
-                success = np.allclose(data[0], sos_ds[group][prior][:][test_indexes,index_t])
+            if parallel: metas = [meta for meta in metas if meta.key in rank_keys]
+            self.read_ids(run_type, sos_file, metas)
+            if parallel:
+                sos_ds = Dataset(sos_file, 'a', parallel=True, comm=comm, info=MPI.Info())
             else:
-                sos_ds[group][prior][prior_indexes] = data
-                success = np.allclose(data, sos_ds[group][prior][test_indexes])
-            
-            # Status
-            if success:
-                if source == "gbreach" or source == "gbnode": source = "gbpriors"
-                print(f"{source.upper()}: '{prior}' has been overwritten in the SoS ({run_type}).")
-            else:
-                if source == "gbreach" or source == "gbnode": source = "gbpriors"
-                print(f"FAILURE: {source.upper()}: '{prior}' has NOT been overwritten in the SoS ({run_type}).")
+                sos_ds = Dataset(sos_file, 'a')
+            sos_ds.set_auto_mask(False)
+            sos_ds.set_auto_scale(False)
+            sos_ds.set_always_mask(False)
+
+            # Size the chunk cache once per SoS variable as setting it reopens
+            # the variable and empties the cache
+            cached_vars = set()
+
+            for meta in metas:
+
+                # Prior data
+                source, prior, prior_vars = meta.source, meta.prior, meta.variables
+                group = self.determine_group(source)
+                sos_var = sos_ds[group][prior]
+                if (group, prior) not in cached_vars:
+                    sos_var.set_var_chunk_cache(size=self.CHUNK_CACHE_SIZE,
+                        nelems=self.CHUNK_CACHE_NELEMS, preemption=self.CHUNK_CACHE_PREEMPTION)
+                    cached_vars.add((group, prior))
+                prior_indexes = np.ascontiguousarray(prior_vars["indexes"][:], dtype=np.intp)
+
+                # Test data
+                prior_ids, id_lookup = self.retrieve_ids(source, run_type, prior_vars)
+                test_indexes = self.lookup_indexes(id_lookup, prior_ids)
+
+                # Overwrite
+                if "value_t" in prior_vars.keys():
+                    data = np.ascontiguousarray(prior_vars["prior_values"][0], dtype=sos_var.dtype)
+                    prior_t = prior_vars["value_t"][0].astype(int)
+                    t_lookup = self.retrieve_times(run_type, group, prior, sos_ds)
+                    index_t = self.lookup_indexes(t_lookup, prior_t)
+                    if (index_t < 0).any():
+                        # Time values not present in the SoS
+                        success = False
+                    else:
+                        values = np.broadcast_to(data, (len(prior_indexes), len(index_t)))
+                        self.write_prior(sos_var, prior_indexes, values, index_t, dense=not parallel)
+                        success = True
+                else:
+                    self.write_prior(sos_var, prior_indexes, prior_vars["prior_values"], dense=not parallel)
+                    success = True
+
+                # Verify, only reading back from the SoS when the identifiers
+                # do not map to the indexes that were written; an overwrite is
+                # bit-exact so values are compared exactly
+                if success and not np.array_equal(prior_indexes, test_indexes):
+                    if (test_indexes < 0).any():
+                        # Identifiers not present in the SoS
+                        success = False
+                    elif "value_t" in prior_vars.keys():
+                        success = np.array_equal(values, sos_var[test_indexes,index_t])
+                    else:
+                        data = prior_vars["prior_values"][:].astype(sos_var.dtype)
+                        success = np.array_equal(data, sos_var[test_indexes])
+                
+                # Status
+                print_source = _PRINT_SOURCE.get(source, source.upper())
+                if success:
+                    logger.info("%s: '%s' has been overwritten in the SoS (%s).", print_source, prior, run_type)
+                else:
+                    logger.error("FAILURE: %s: '%s' has NOT been overwritten in the SoS (%s).", print_source, prior, run_type)
 
             sos_ds.close()
-        priors_ds.close()     
 
-    def retrieve_ids(self, source, priors_ds, sos_ds):
-        """Retrieve reach identifiers for priors and from SoS.
+    def read_ids(self, run_type, sos_file, metas):
+        """Read SoS identifiers directly from the HDF5 file.
+
+        Identifiers are read into preallocated arrays with h5py, bypassing the
+        netCDF4 wrapper, and cached as lookups of identifier to index. This is
+        done before the SoS is opened for writing so the file is not opened
+        twice at once.
+
+        Parameters
+        ----------
+        run_type: str
+            Run type of the SoS identifiers are read from
+        sos_file: Path
+            Path to the SoS file
+        metas: list
+            List of PriorMeta for the priors of the run type
+        """
+
+        keys = {(run_type, self.sos_id_path(meta.source, meta.variables)) for meta in metas}
+        keys = [key for key in keys if key not in self._id_cache]
+        if not keys: return
+
+        with h5py.File(sos_file, 'r') as f:
+            for key in keys:
+                dset = f[key[1]]
+                sos_ids = np.empty(dset.shape, dtype=dset.dtype)
+                if sos_ids.size: dset.read_direct(sos_ids)
+                self._id_cache[key] = dict(zip(sos_ids.tolist(), range(len(sos_ids))))
+
+    def retrieve_ids(self, source, run_type, prior_vars):
+        """Retrieve reach or node identifiers for priors and from SoS.
+
+        The lookup of SoS identifier to index is taken from the cache that
+        read_ids populates before the SoS file is opened.
         
         Parameters
         ----------
         source: str
             Name of prior source
-        priors_ds: netCDF4.Dataset
-            Dataset with prior values
+        run_type: str
+            Run type of the SoS identifiers are retrieved from
+        prior_vars: dict
+            Dictionary of prior variables
+        """
+
+        if "reach_id" in prior_vars.keys():
+            prior_ids = prior_vars["reach_id"][:]
+        else:
+            prior_ids = prior_vars["node_id"][:]
+        prior_ids = np.ascontiguousarray(prior_ids, dtype=np.int64)
+
+        return prior_ids, self._id_cache[(run_type, self.sos_id_path(source, prior_vars))]
+
+    def retrieve_times(self, run_type, group, prior, sos_ds):
+        """Retrieve a lookup of SoS time value to index and cache it.
+
+        Regular time axes are cached as (start, step, size) so indexes are
+        computed directly; irregular axes are cached as a dictionary.
+
+        Parameters
+        ----------
+        run_type: str
+            Run type of the SoS time values are retrieved from
+        group: str
+            SoS group the prior belongs to
+        prior: str
+            Name of prior
         sos_ds: netCDF4.Dataset
             SoS dataset
         """
 
-        if source == "usgs":
-            prior_ids = priors_ds["reach_id"][:]
-            sos_ids = sos_ds["model"]["usgs"]["usgs_reach_id"][:]
+        key = (run_type, group, prior)
+        if key not in self._t_cache:
+            sos_t = sos_ds[group][f"{prior}t"][0].astype(int)
+            steps = np.diff(sos_t)
+            if len(steps) and steps[0] > 0 and (steps == steps[0]).all():
+                self._t_cache[key] = (int(sos_t[0]), int(steps[0]), len(sos_t))
+            else:
+                self._t_cache[key] = dict(zip(sos_t.tolist(), range(len(sos_t))))
+        return self._t_cache[key]
+
+    def sos_id_path(self, source, prior_vars):
+        """Determine the path of the SoS identifiers for a prior.
+
+        Parameters
+        ----------
+        source: str
+            Name of prior source
+        prior_vars: dict
+            Dictionary of prior variables
+        """
+
+        if "reach_id" not in prior_vars.keys():
+            return "nodes/node_id"
+        elif source == "usgs":
+            return "model/usgs/usgs_reach_id"
         elif source == "grdc":
-            prior_ids = priors_ds["reach_id"][:]
-            sos_ids = sos_ds["model"]["grdc"]["grdc_reach_id"][:]
+            return "model/grdc/grdc_reach_id"
         else:
-            prior_ids = priors_ds["reach_id"][:]
-            sos_ids = sos_ds["reaches"]["reach_id"][:]
+            return "reaches/reach_id"
 
-        return prior_ids, sos_ids
+    def write_prior(self, sos_var, prior_indexes, prior_data, index_t=None, dense=True):
+        """Write prior data to SoS variable.
+
+        Indexes are sorted once; when most of the variable is overwritten and
+        dense updates are allowed it is read, updated and written back whole.
+        Otherwise prior data, read once and sorted in memory, is written in
+        slabs that fall within the same SoS chunks; each slab is written with
+        a single selection unless its indexes form long contiguous runs, which
+        are written as slices.
+
+        A sample of the prior data is compared to the SoS once; only when it
+        matches is the remaining data compared so that data the SoS already
+        holds is not written.
+
+        Parameters
+        ----------
+        sos_var: netCDF4.Variable
+            SoS variable to overwrite
+        prior_indexes: numpy.ndarray
+            SoS indexes to overwrite
+        prior_data: netCDF4.Variable or numpy.ndarray
+            Prior data values with a row for each index
+        index_t: numpy.ndarray
+            SoS time indexes to overwrite (optional)
+        dense: bool
+            Indicates whether the whole variable may be written back
+        """
+
+        if len(prior_indexes) == 0: return
+        order = np.argsort(prior_indexes)
+        pi_s = prior_indexes[order]
+
+        # Read prior data once and sort it in memory with the indexes
+        data_s = np.ascontiguousarray(prior_data[:], dtype=sos_var.dtype)[order]
+
+        # Compare a sample so changed data is detected with a small read
+        n = min(self.SAMPLE_SIZE, len(pi_s))
+        current = self.is_unchanged(sos_var, pi_s[:n], data_s[:n], index_t)
+        if current and n == len(pi_s): return
+
+        # Dense update
+        if dense and len(pi_s) / sos_var.shape[0] > self.DENSE_FRACTION:
+            buf = sos_var[:]
+            existing = buf[pi_s] if index_t is None else buf[np.ix_(pi_s, index_t)]
+            if current and np.array_equal(existing, data_s): return
+            if index_t is None:
+                buf[pi_s] = data_s
+            else:
+                buf[np.ix_(pi_s, index_t)] = data_s
+            sos_var[:] = buf
+            return
+
+        # Slabs of indexes that fall within the same SoS chunks
+        chunking = sos_var.chunking()
+        chunk = sos_var.shape[0] if chunking is None or chunking == "contiguous" else chunking[0]
+        slabs = np.concatenate(([0], np.flatnonzero(np.diff(pi_s // chunk)) + 1, [len(pi_s)]))
+        for slab_lo, slab_hi in zip(slabs[:-1].tolist(), slabs[1:].tolist()):
+            pi_slab = pi_s[slab_lo:slab_hi]
+            data_slab = data_s[slab_lo:slab_hi]
+            if current and self.is_unchanged(sos_var, pi_slab, data_slab, index_t): continue
+
+            # Long contiguous runs are written as slices of the sorted data;
+            # scattered indexes are written with a single selection
+            bounds = np.concatenate(([0], np.flatnonzero(np.diff(pi_slab) != 1) + 1, [len(pi_slab)]))
+            num_runs = len(bounds) - 1
+            if num_runs == 1 or len(pi_slab) / num_runs >= self.MIN_RUN_LENGTH:
+                for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+                    start, stop = pi_slab[lo], pi_slab[hi - 1] + 1
+                    if index_t is None:
+                        sos_var[start:stop] = data_slab[lo:hi]
+                    else:
+                        sos_var[start:stop, index_t] = data_slab[lo:hi]
+            elif index_t is None:
+                sos_var[pi_slab] = data_slab
+            else:
+                sos_var[pi_slab, index_t] = data_slab
 
 if __name__ == "__main__":
+
+    # Buffer status messages and emit them in bulk
+    handler = logging.handlers.MemoryHandler(capacity=256, flushLevel=logging.ERROR,
+        target=logging.StreamHandler(sys.stdout))
+    logging.basicConfig(level=logging.INFO, handlers=[handler])
     
     priors_file = Path("")
     sos_dir = Path("")
 
-    overwrite = Overwrite(priors_file)
-    overwrite.overwrite(sos_dir)
\ No newline at end of file
+    with Overwrite(priors_file) as overwrite:
+        overwrite.overwrite(sos_dir)
\ No newline at end of file
@@ -30,6 +30,8 @@ class PriorStore:
         List of variables stored on the num_days dimension
     PROB_LIST: list
         List of variables stored on the probability dimension
+    SEPARATOR: str
+        Separator between a prior's name and its variable and dimension names
 
     Methods
     -------
@@ -43,6 +45,7 @@ class PriorStore:
     MONTHS_LIST = ["monthly_q"]
     DAYS_LIST =  ["grdc_q", "usgs_q"]
     PROB_LIST = ["flow_duration_q"]
+    SEPARATOR = "__"
 
     def __init__(self, author, email, sos_file, output_dir):
         """
@@ -80,75 +83,82 @@ class PriorStore:
         """Creates a NetCDF file from priors_dict attribute. 
         
         The resulting file can be emailed to request the overwrite operation.
+        The file is written in the CDF-5 classic format without groups so each
+        prior's dimensions and variables are named '<source>_<prior>__<name>'.
+        All dimensions and variables are defined before any data is written and
+        the file is built in memory and written to disk when it is closed.
         """
 
         # NetCDF file and global attributes
-        file_name = self.output_dir / f"{author.replace(' ', '_').lower()}_{self.sos_file.split('_')[0]}.nc"
-        ds = Dataset(file_name, 'w')
+        file_name = self.output_dir / f"{author.replace(' ', '_').lower()}_{self.sos_file.partition('_')[0]}.nc"
+        ds = Dataset(file_name, 'w', format="NETCDF3_64BIT_DATA", diskless=True, persist=True)
         ds.author = self.author
         ds.contact = self.email
         ds.sos_file = self.sos_file
         ds.production_date = datetime.now().strftime('%d-%b-%Y %H:%M:%S')
 
-        # Groups
+        # Define dimensions and variables for each prior of sources that have data
+        values = []
         for source in self.priors_dict.keys():
-            # Check if the group has data
             if self.priors_dict[source]:
-                # Create groups for each prior and populate with data
                 for prior, data in self.priors_dict[source].items():
-                    # Group
-                    g = ds.createGroup(f"{source}_{prior}")
-
-                    # Attribute
-                    g.run_type = data["run_type"]
+                    prefix = f"{source}_{prior}{self.SEPARATOR}"
 
                     # Dimensions
+                    num_days = len(data["value_t"][0]) if "value_t" in data.keys() else None
                     if "reach_ids" in data.keys(): 
-                        self.create_dimensions(source, g, num_reaches=len(data["reach_ids"]))
+                        self.create_dimensions(source, prefix, ds, num_reaches=len(data["reach_ids"]), num_days=num_days)
                     else:
-                        self.create_dimensions(source, g, num_nodes=len(data["node_ids"]))
+                        self.create_dimensions(source, prefix, ds, num_nodes=len(data["node_ids"]), num_days=num_days)
 
                     # Variables
-                    self.create_variables(source, prior, data, g)
+                    values.extend(self.create_variables(source, prior, prefix, data, ds))
+
+        # Populate variables with data
+        for var, value in values:
+            var[:] = value
 
         # Close dataset file
         ds.close()
 
-    def create_dimensions(self, source, ds, num_reaches=None, num_nodes=None):
-        """Create the netCDF dimensions for the group.
+    def create_dimensions(self, source, prefix, ds, num_reaches=None, num_nodes=None, num_days=None):
+        """Create the netCDF dimensions for the prior.
 
         source: str
             Name of source to determine what dimensions to create
+        prefix: str
+            Prefix of the prior dimension names
         ds: netCDF4.Dataset
             Dataset to create dimension in
         num_reaches: int
             Number of reaches included in priors data
         num_nodes: int
             Number of nodes included in priors data
+        num_days: int
+            Number of days included in priors data
         """
 
-        if num_reaches: ds.createDimension("num_reaches", num_reaches)
-        if num_nodes: ds.createDimension("num_nodes", num_nodes)
+        if num_reaches: ds.createDimension(f"{prefix}num_reaches", num_reaches)
+        if num_nodes: ds.createDimension(f"{prefix}num_nodes", num_nodes)
 
         if source == "wbm" or source == "grades" or source == "grdc" or source == "usgs":
             # Months
-            ds.createDimension("num_months", 12)
+            if "num_months" not in ds.dimensions.keys(): ds.createDimension("num_months", 12)
 
             # Probability values for flow duration curve
-            ds.createDimension("probability", 20)
+            if "probability" not in ds.dimensions.keys(): ds.createDimension("probability", 20)
 
-        if source == "grdc":
+        if source == "grdc" or source == "usgs":
             # Number of days
-            ds.createDimension("num_days", None)
+            if num_days: ds.createDimension(f"{prefix}num_days", num_days)
 
         if source == "usgs":
-            # Number of days
-            ds.createDimension("num_days", None)
             # Character units for USGS identifier
-            ds.createDimension("nchars", 16)
+            if "nchars" not in ds.dimensions.keys(): ds.createDimension("nchars", 16)
 
-    def create_variables(self, source, prior, data, ds):
-        """Create and populate NetCDF variables.
+    def create_variables(self, source, prior, prefix, data, ds):
+        """Create NetCDF variables and return them with the data to populate
+        them with.
         
         Parameters
         ----------
@@ -156,6 +166,8 @@ class PriorStore:
             Name of data source
         prior: str
             Name of prior
+        prefix: str
+            Prefix of the prior variable and dimension names
         data: dict
             Dictionary of variables to create and populate
         ds: netCDF4.Dataset
@@ -164,57 +176,40 @@ class PriorStore:
 
         # Store variable-length data
         if source == "gbnode" and prior in self.NODE_LIST:
-            node_id = ds.createVariable("node_id", "i8", ("num_nodes",))
-            node_id[:] = data["node_ids"]
-
-            indexes = ds.createVariable("indexes", "i4", ("num_nodes",))
-            indexes[:] = data["indexes"]
-
-            values = ds.createVariable("prior_values", data["data_type"], ("num_nodes",))
-            values[:] = data["values"]
+            node_id = ds.createVariable(f"{prefix}node_id", "i8", (f"{prefix}num_nodes",), fill_value=False)
+            indexes = ds.createVariable(f"{prefix}indexes", "i4", (f"{prefix}num_nodes",), fill_value=False)
+            values = ds.createVariable(f"{prefix}prior_values", data["data_type"], (f"{prefix}num_nodes",), fill_value=False)
+            variables = [(node_id, data["node_ids"]), (indexes, data["indexes"]), (values, data["values"])]
 
         elif prior in self.PROB_LIST:
-            reach_id = ds.createVariable("reach_id", "i8", ("num_reaches",))
-            reach_id[:] = data["reach_ids"]
-
-            indexes = ds.createVariable("indexes", "i4", ("num_reaches",))
-            indexes[:] = data["indexes"]
-
-            values = ds.createVariable("prior_values", data["data_type"], ("num_reaches", "probability"))
-            values[:] = data["values"]
+            reach_id = ds.createVariable(f"{prefix}reach_id", "i8", (f"{prefix}num_reaches",), fill_value=False)
+            indexes = ds.createVariable(f"{prefix}indexes", "i4", (f"{prefix}num_reaches",), fill_value=False)
+            values = ds.createVariable(f"{prefix}prior_values", data["data_type"], (f"{prefix}num_reaches", "probability"), fill_value=False)
+            variables = [(reach_id, data["reach_ids"]), (indexes, data["indexes"]), (values, data["values"])]
 
         elif prior in self.MONTHS_LIST:
-            reach_id = ds.createVariable("reach_id", "i8", ("num_reaches",))
-            reach_id[:] = data["reach_ids"]
-
-            indexes = ds.createVariable("indexes", "i4", ("num_reaches",))
-            indexes[:] = data["indexes"]
-
-            values = ds.createVariable("prior_values", data["data_type"], ("num_reaches", "num_months"))
-            values[:] = data["values"]
+            reach_id = ds.createVariable(f"{prefix}reach_id", "i8", (f"{prefix}num_reaches",), fill_value=False)
+            indexes = ds.createVariable(f"{prefix}indexes", "i4", (f"{prefix}num_reaches",), fill_value=False)
+            values = ds.createVariable(f"{prefix}prior_values", data["data_type"], (f"{prefix}num_reaches", "num_months"), fill_value=False)
+            variables = [(reach_id, data["reach_ids"]), (indexes, data["indexes"]), (values, data["values"])]
 
         elif prior in self.DAYS_LIST:
-            reach_id = ds.createVariable("reach_id", "i8", ("num_reaches",))
-            reach_id[:] = data["reach_ids"]
-
-            indexes = ds.createVariable("indexes", "i4", ("num_reaches",))
-            indexes[:] = data["indexes"]
-
-            values = ds.createVariable("prior_values", data["data_type"], ("num_reaches", "num_days"))
-            values[:] = data["values"]
-
-            value_t = ds.createVariable("value_t", "f8", ("num_reaches", "num_days"))
-            value_t[:] = data["value_t"]
+            reach_id = ds.createVariable(f"{prefix}reach_id", "i8", (f"{prefix}num_reaches",), fill_value=False)
+            indexes = ds.createVariable(f"{prefix}indexes", "i4", (f"{prefix}num_reaches",), fill_value=False)
+            values = ds.createVariable(f"{prefix}prior_values", data["data_type"], (f"{prefix}num_reaches", f"{prefix}num_days"), fill_value=False)
+            value_t = ds.createVariable(f"{prefix}value_t", "f8", (f"{prefix}num_reaches", f"{prefix}num_days"), fill_value=False)
+            variables = [(reach_id, data["reach_ids"]), (indexes, data["indexes"]), (values, data["values"]), (value_t, data["value_t"])]
 
         else:
-            reach_id = ds.createVariable("reach_id", "i8", ("num_reaches",))
-            reach_id[:] = data["reach_ids"]
+            reach_id = ds.createVariable(f"{prefix}reach_id", "i8", (f"{prefix}num_reaches",), fill_value=False)
+            indexes = ds.createVariable(f"{prefix}indexes", "i4", (f"{prefix}num_reaches",), fill_value=False)
+            values = ds.createVariable(f"{prefix}prior_values", data["data_type"], (f"{prefix}num_reaches",), fill_value=False)
+            variables = [(reach_id, data["reach_ids"]), (indexes, data["indexes"]), (values, data["values"])]
 
-            indexes = ds.createVariable("indexes", "i4", ("num_reaches",))
-            indexes[:] = data["indexes"]
+        # Attribute
+        values.run_type = data["run_type"]
 
-            values = ds.createVariable("prior_values", data["data_type"], ("num_reaches",))
-            values[:] = data["values"]
+        return variables
 
 
 if __name__ == "__main__":